@@ -1,24 +1,101 @@
+import html
 try:
-    from cgi import escape
-    import cgi
+    # cgi.escape was removed in python 3.8; bind the escape function once
+    # at import time instead of branching on every Chapter
+    from cgi import escape as _escape
 except ImportError:
-    import html
+    _escape = html.escape
 import codecs
+import concurrent.futures
+import functools
 import imghdr
 import os
+import re
 import shutil
-import tempfile
-import urllib.request, urllib.parse, urllib.error
 import urllib.parse
 import uuid
 
-import bs4
 from bs4 import BeautifulSoup
-from bs4.dammit import EntitySubstitution
 import requests
 
 from . import clean
 
+try:
+    import lxml
+    DEFAULT_PARSER = 'lxml'
+except ImportError:
+    DEFAULT_PARSER = 'html.parser'
+
+TITLE_REGEX = re.compile(r'<title[^>]*>(.*?)</title>',
+                         re.IGNORECASE | re.DOTALL)
+
+USER_AGENT = r'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0'
+
+IMAGE_DOWNLOAD_POOL_SIZE = 8
+
+IMAGE_EXTENSIONS = {
+    '.jpg': 'jpg',
+    '.jpeg': 'jpeg',
+    '.gif': 'gif',
+    '.png': 'png',
+    '.webp': 'webp',
+}
+
+
+def _create_session():
+    """
+    Creates the requests.Session shared by all downloads in this module.
+    Keeping a single session enables connection pooling and keep-alive,
+    which avoids a fresh TCP+TLS handshake for every request.
+    """
+    session = requests.Session()
+    session.headers.update({'User-Agent': USER_AGENT})
+    retry = requests.packages.urllib3.util.retry.Retry(
+            total=3, backoff_factor=0.5)
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16,
+                                            pool_maxsize=32,
+                                            max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+_SESSION = _create_session()
+
+# Cache of (image_directory, image_url) -> saved file name ('<name>.<ext>').
+# Books commonly repeat the same image (logos, headers) across chapters;
+# this makes each url cost one download per book instead of one per
+# chapter. Only successful downloads are cached, so a transient failure in
+# one chapter is retried in the next, and the cache is bounded to
+# IMAGE_CACHE_MAX_SIZE entries (oldest evicted first).
+_IMAGE_CACHE = {}
+
+IMAGE_CACHE_MAX_SIZE = 256
+
+
+def _cache_image(image_directory, image_url, image_file_name):
+    if len(_IMAGE_CACHE) >= IMAGE_CACHE_MAX_SIZE:
+        # Dicts iterate in insertion order, so this drops the oldest entry
+        del _IMAGE_CACHE[next(iter(_IMAGE_CACHE))]
+    _IMAGE_CACHE[(image_directory, image_url)] = image_file_name
+
+
+def _parse_html(markup):
+    """
+    Parses an html string into a BeautifulSoup tree using the fastest
+    available parser, falling back to the pure-python parser if the
+    markup is too broken for lxml.
+
+    Args:
+        markup (str): A string representing HTML.
+
+    Returns:
+        bs4.BeautifulSoup: The parsed tree.
+    """
+    try:
+        return BeautifulSoup(markup, DEFAULT_PARSER)
+    except Exception:
+        return BeautifulSoup(markup, 'html.parser')
+
 
 class NoUrlError(Exception):
     def __str__(self):
@@ -33,24 +110,26 @@ class ImageErrorException(Exception):
         return 'Error downloading image from ' + self.image_url
 
 
+@functools.lru_cache(maxsize=4096)
 def get_image_type(url):
-    for ending in ['jpg', 'jpeg', '.gif' '.png']:
-        if url.endswith(ending):
-            return ending
-    else:
-        try:
-            f, temp_file_name = tempfile.mkstemp()
-            urllib.request.urlretrieve(url, temp_file_name)
-            image_type = imghdr.what(temp_file_name)
-            return image_type
-        except IOError:
-            return None
+    """
+    Guesses the image extension from the url alone, without any network
+    traffic. Returns None if the url path doesn't end in a known image
+    suffix, in which case save_image sniffs the type from the image bytes
+    instead. Results are cached since the same image url commonly recurs
+    across the chapters of a book.
+    """
+    path = urllib.parse.urlparse(url).path
+    extension = os.path.splitext(path)[1].lower()
+    return IMAGE_EXTENSIONS.get(extension)
 
 
 def save_image(image_url, image_directory, image_name):
     """
     Saves an online image from image_url to image_directory with the name image_name.
-    Returns the extension of the image saved, which is determined dynamically.
+    Returns the extension of the image saved, which is determined from the url
+    or, failing that, from the first bytes of the image itself. The image is
+    downloaded exactly once.
 
     Args:
         image_url (str): The url of the image.
@@ -61,63 +140,69 @@ def save_image(image_url, image_directory, image_name):
         ImageErrorException: Raised if unable to save the image at image_url
     """
     image_type = get_image_type(image_url)
-    if image_type is None:
-        raise ImageErrorException(image_url)
-    full_image_file_name = os.path.join(image_directory, image_name + '.' + image_type)
 
     # If the image is present on the local filesystem just copy it
     if os.path.exists(image_url):
+        if image_type is None:
+            try:
+                with open(image_url, 'rb') as f:
+                    image_type = imghdr.what(None, h=f.read(32))
+            except IOError:
+                image_type = None
+        if image_type is None:
+            raise ImageErrorException(image_url)
+        full_image_file_name = os.path.join(image_directory, image_name + '.' + image_type)
         shutil.copy(image_url, full_image_file_name)
         return image_type
 
     try:
-        # urllib.urlretrieve(image_url, full_image_file_name)
+        requests_object = _SESSION.get(image_url, stream=True,
+                                       timeout=(5, 30))
+        requests_object.raise_for_status()
+        # Reading raw bypasses requests' transparent decompression, so ask
+        # urllib3 to decode gzip/deflate bodies itself
+        requests_object.raw.decode_content = True
+        # Peek at the leading bytes so the type can be sniffed without a
+        # separate download
+        header_bytes = requests_object.raw.read(32)
+        if image_type is None:
+            image_type = imghdr.what(None, h=header_bytes)
+        if image_type is None:
+            raise ImageErrorException(image_url)
+        full_image_file_name = os.path.join(image_directory, image_name + '.' + image_type)
         with open(full_image_file_name, 'wb') as f:
-            user_agent = r'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0'
-            request_headers = {'User-Agent': user_agent}
-            requests_object = requests.get(image_url, headers=request_headers)
-            try:
-                content = requests_object.content
-                # Check for empty response
-                f.write(content)
-            except AttributeError:
-                raise ImageErrorException(image_url)
-    except IOError:
+            f.write(header_bytes)
+            # Copy the body in fixed-size chunks so memory stays O(64KB)
+            # no matter how large the image is
+            shutil.copyfileobj(requests_object.raw, f, length=64 * 1024)
+    except (IOError, requests.exceptions.RequestException,
+            requests.packages.urllib3.exceptions.HTTPError):
+        # Reading from the raw stream surfaces urllib3 errors (timeouts,
+        # dropped connections) without requests' exception wrapping
         raise ImageErrorException(image_url)
     return image_type
 
 
-def _replace_image(image_url, image_tag, ebook_folder,
-                   image_name=None):
+def _download_image(image_url, image_directory, image_name):
     """
-    Replaces the src of an image to link to the local copy in the images folder of the ebook. Tightly coupled with bs4
-        package.
+    Downloads the image at image_url into image_directory under the name
+    image_name. Unlike save_image this never raises on a bad image, so it
+    is safe to run from a worker thread; it also never touches the
+    BeautifulSoup tree.
 
     Args:
         image_url (str): The url of the image.
-        image_tag (bs4.element.Tag): The bs4 tag containing the image.
-        ebook_folder (str): The directory where the ebook files are being saved. This must contain a subdirectory
-            called "images".
-        image_name (Option[str]): The short name to save the image as. Should not contain a directory or an extension.
+        image_directory (str): The directory to save the image in.
+        image_name (str): The file name to save the image as.
+
+    Returns:
+        Option[str]: The extension of the saved image, or None if the
+            image could not be downloaded.
     """
     try:
-        assert isinstance(image_tag, bs4.element.Tag)
-    except AssertionError:
-        raise TypeError("image_tag cannot be of type " + str(type(image_tag)))
-    if image_name is None:
-        image_name = str(uuid.uuid4())
-    try:
-        image_full_path = os.path.join(ebook_folder, 'images')
-        assert os.path.exists(image_full_path)
-        image_extension = save_image(image_url, image_full_path,
-                                     image_name)
-        image_tag['src'] = 'images' + '/' + image_name + '.' + image_extension
+        return save_image(image_url, image_directory, image_name)
     except ImageErrorException:
-        image_tag.decompose()
-    except AssertionError:
-        raise ValueError('%s doesn\'t exist or doesn\'t contain a subdirectory images' % ebook_folder)
-    except TypeError:
-        image_tag.decompose()
+        return None
 
 
 class Chapter(object):
@@ -132,6 +217,9 @@ class Chapter(object):
         title (str): The title of the chapter.
         url (Option[str]): The url of the webpage where the chapter is from if
             applicable. By default this is None.
+        content_tree (Option[bs4.BeautifulSoup]): A tree already parsed from
+            content, if the caller happens to have one. By default this is
+            None, in which case content is parsed on construction.
 
     Attributes:
         content (str): The content of the ebook chapter.
@@ -141,16 +229,26 @@ class Chapter(object):
         html_title (str): Title string with special characters replaced with
             html-safe sequences
     """
-    def __init__(self, content, title, url=None):
+    def __init__(self, content, title, url=None, content_tree=None):
         self._validate_input_types(content, title)
         self.title = title
         self.content = content
-        self._content_tree = BeautifulSoup(self.content, 'html.parser')
+        if content_tree is not None:
+            self._content_tree = content_tree
         self.url = url
-        try:
-            self.html_title = cgi.escape(self.title, quote=True)
-        except NameError:
-            self.html_title = html.escape(self.title, quote=True)
+        self.html_title = _escape(self.title, quote=True)
+
+    @property
+    def content(self):
+        """The content of the chapter as a unicode string."""
+        return self._content_bytes.decode('utf-8')
+
+    @content.setter
+    def content(self, value):
+        # Content is kept as utf-8 bytes internally so write() never has
+        # to re-encode the whole document
+        self.__dict__.pop('_content_tree', None)
+        self._content_bytes = value.encode('utf-8')
 
     def write(self, file_name):
         """
@@ -159,31 +257,27 @@ class Chapter(object):
         Args:
             file_name (str): The full name of the xhtml file to save to.
         """
-        try:
-            assert file_name[-6:] == '.xhtml'
-        except (AssertionError, IndexError):
+        if not file_name.endswith('.xhtml'):
             raise ValueError('filename must end with .xhtml')
         with open(file_name, 'wb') as f:
-            f.write(self.content.encode('utf-8'))
+            f.write(self._content_bytes)
 
     def _validate_input_types(self, content, title):
-        try:
-            assert isinstance(content, str)
-        except AssertionError:
+        if not isinstance(content, str):
             raise TypeError('content must be a string')
-        try:
-            assert isinstance(title, str)
-        except AssertionError:
+        if not isinstance(title, str):
             raise TypeError('title must be a string')
-        try:
-            assert title != ''
-        except AssertionError:
+        if title == '':
             raise ValueError('title cannot be empty string')
-        try:
-            assert content != ''
-        except AssertionError:
+        if content == '':
             raise ValueError('content cannot be empty string')
 
+    @functools.cached_property
+    def _content_tree(self):
+        # Parsing is the most expensive operation on a chapter, so it is
+        # deferred until something actually needs the tree.
+        return _parse_html(self.content)
+
     def get_url(self):
         if self.url is not None:
             return self.url
@@ -191,21 +285,62 @@ class Chapter(object):
             raise NoUrlError()
 
     def _get_image_urls(self):
-        image_nodes = self._content_tree.find_all('img')
-        raw_image_urls = [node['src'] for node in image_nodes if node.has_attr('src')]
-        full_image_urls = [urllib.parse.urljoin(self.url, image_url) for image_url in raw_image_urls]
-        image_nodes_filtered = [node for node in image_nodes if node.has_attr('src')]
-        return list(zip(image_nodes_filtered, full_image_urls))
+        return [(node, urllib.parse.urljoin(self.url, node['src']))
+                for node in self._content_tree.find_all('img')
+                if node.has_attr('src')]
 
     def _replace_images_in_chapter(self, ebook_folder):
+        if b'<img' not in self._content_bytes:
+            # Nothing to replace; skip parsing the chapter entirely
+            return
         image_url_list = self._get_image_urls()
-        for image_tag, image_url in image_url_list:
-            _replace_image(image_url, image_tag, ebook_folder)
-        unformatted_html_unicode_string = str(self._content_tree.prettify(encoding='utf-8',
-                                                                              formatter=EntitySubstitution.substitute_html),
-                                                  encoding='utf-8')
-        unformatted_html_unicode_string = unformatted_html_unicode_string.replace('<br>', '<br/>')
-        self.content = unformatted_html_unicode_string
+        if image_url_list:
+            image_directory = os.path.join(ebook_folder, 'images')
+            if not os.path.exists(image_directory):
+                raise ValueError('%s doesn\'t exist or doesn\'t contain a subdirectory images' % ebook_folder)
+            # Pages frequently repeat the same image (logos, icons);
+            # bucket tags by url so each unique url is fetched only once.
+            url_to_tags = {}
+            for image_tag, image_url in image_url_list:
+                url_to_tags.setdefault(image_url, []).append(image_tag)
+            image_file_names = {
+                    image_url: _IMAGE_CACHE[(image_directory, image_url)]
+                    for image_url in url_to_tags
+                    if (image_directory, image_url) in _IMAGE_CACHE}
+            uncached_image_urls = [image_url for image_url in url_to_tags
+                                   if image_url not in image_file_names]
+            if uncached_image_urls:
+                image_names = [str(uuid.uuid4()) for _ in uncached_image_urls]
+                # Downloads are I/O bound, so fan them out to a thread pool;
+                # tag mutation stays in this thread since bs4 trees are not
+                # threadsafe.
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=IMAGE_DOWNLOAD_POOL_SIZE) as executor:
+                    image_extensions = list(executor.map(
+                            _download_image,
+                            uncached_image_urls,
+                            [image_directory] * len(uncached_image_urls),
+                            image_names))
+                for image_url, image_name, image_extension in \
+                        zip(uncached_image_urls, image_names, image_extensions):
+                    if image_extension is None:
+                        image_file_names[image_url] = None
+                    else:
+                        image_file_names[image_url] = \
+                                image_name + '.' + image_extension
+                        _cache_image(image_directory, image_url,
+                                     image_file_names[image_url])
+            for image_url, image_tags in url_to_tags.items():
+                image_file_name = image_file_names[image_url]
+                for image_tag in image_tags:
+                    if image_file_name is None:
+                        image_tag.decompose()
+                    else:
+                        image_tag['src'] = 'images' + '/' + image_file_name
+        # Take the serialized bytes directly; going through the content
+        # setter would decode and re-encode the whole document (the cached
+        # tree already matches the new bytes, so it can stay)
+        self._content_bytes = self._content_tree.encode(formatter='html')
 
 
 class ChapterFactory(object):
@@ -221,8 +356,6 @@ class ChapterFactory(object):
 
     def __init__(self, clean_function=clean.clean):
         self.clean_function = clean_function
-        user_agent = r'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0'
-        self.request_headers = {'User-Agent': user_agent}
 
     def create_chapter_from_url(self, url, title=None):
         """
@@ -246,7 +379,7 @@ class ChapterFactory(object):
             ValueError: Raised if unable to connect to url supplied
         """
         try:
-            request_object = requests.get(url, headers=self.request_headers, allow_redirects=False)
+            request_object = _SESSION.get(url, allow_redirects=False)
         except (requests.exceptions.MissingSchema,
                 requests.exceptions.ConnectionError):
             raise ValueError("%s is an invalid url or no network connection" % url)
@@ -297,18 +430,13 @@ class ChapterFactory(object):
         """
         clean_html_string = self.clean_function(html_string)
         clean_xhtml_string = clean.html_to_xhtml(clean_html_string)
-        if title:
-            pass
-        else:
-            try:
-                root = BeautifulSoup(html_string, 'html.parser')
-                title_node = root.title
-                if title_node is not None:
-                    title = str(title_node.string)
-                else:
-                    raise ValueError
-            except (IndexError, ValueError):
-                title = 'Ebook Chapter'
+        if not title:
+            title_match = TITLE_REGEX.search(html_string)
+            if title_match:
+                title = html.unescape(title_match.group(1)).strip()
+            # An absent or whitespace-only <title> falls back to the
+            # default rather than failing Chapter's empty-title check
+            title = title or 'Ebook Chapter'
         return Chapter(clean_xhtml_string, title, url)
 
 create_chapter_from_url = ChapterFactory().create_chapter_from_url
@@ -8,6 +8,12 @@ from bs4.dammit import EntitySubstitution
 from . import constants
 
 
+LEADING_WHITESPACE_REGEX = re.compile(r'>\s+')
+TRAILING_WHITESPACE_REGEX = re.compile(r'\s+<')
+SINGLETON_TAG_REGEX = re.compile(
+        '<(%s)/>' % '|'.join(constants.SINGLETON_TAG_LIST))
+
+
 def create_html_from_fragment(tag):
     """
     Creates full html tree from a fragment. Assumes that tag should be wrapped in a body and is currently not
@@ -19,13 +25,9 @@ def create_html_from_fragment(tag):
         bs4.element.Tag: A bs4 tag representing a full html document
     """
 
-    try:
-        assert isinstance(tag, bs4.element.Tag)
-    except AssertionError:
+    if not isinstance(tag, bs4.element.Tag):
         raise TypeError
-    try:
-        assert tag.find_all('body') == []
-    except AssertionError:
+    if tag.find_all('body') != []:
         raise ValueError
 
     soup = BeautifulSoup('<html><head></head><body></body></html>', 'html.parser')
@@ -55,9 +57,7 @@ def clean(input_string,
     Raises:
         TypeError: Raised if input_string isn't a unicode string or string.
     """
-    try:
-        assert isinstance(input_string, str)
-    except AssertionError:
+    if not isinstance(input_string, str):
         raise TypeError
     root = BeautifulSoup(input_string, 'html.parser')
     article_tag = root.find_all('article')
@@ -81,11 +81,9 @@ def clean(input_string,
     #wrap partial tree if necessary
     if root.find_all('html') == []:
         root = create_html_from_fragment(root)
-    # Remove img tags without src attribute
-    image_node_list = root.find_all('img')
-    for node in image_node_list:
-        if not node.has_attr('src'):
-            node.extract()
+    # Remove img tags without src attribute, in a single selector pass
+    for node in root.select('img:not([src])'):
+        node.extract()
     unformatted_html_unicode_string = str(root.prettify(encoding='utf-8',
                                                             formatter=EntitySubstitution.substitute_html),
                                               encoding='utf-8')
@@ -109,12 +107,10 @@ def condense(input_string):
     Raises:
         TypeError: Raised if input_string isn't a unicode string or string.
     """
-    try:
-        assert isinstance(input_string, str)
-    except AssertionError:
+    if not isinstance(input_string, str):
         raise TypeError
-    removed_leading_whitespace = re.sub('>\s+', '>', input_string).strip()
-    removed_trailing_whitespace = re.sub('\s+<', '<', removed_leading_whitespace).strip()
+    removed_leading_whitespace = LEADING_WHITESPACE_REGEX.sub('>', input_string).strip()
+    removed_trailing_whitespace = TRAILING_WHITESPACE_REGEX.sub('<', removed_leading_whitespace).strip()
     return removed_trailing_whitespace
 
 
@@ -131,23 +127,16 @@ def html_to_xhtml(html_unicode_string):
     Raises:
         TypeError: Raised if input_string isn't a unicode string or string.
     """
-    try:
-        assert isinstance(html_unicode_string, str)
-    except AssertionError:
+    if not isinstance(html_unicode_string, str):
         raise TypeError
     root = BeautifulSoup(html_unicode_string, 'html.parser')
     # Confirm root node is html
-    try:
-        assert root.html is not None
-    except AssertionError:
+    if root.html is None:
         raise ValueError(''.join(['html_unicode_string cannot be a fragment.',
                          'string is the following: %s', str(root)]))
     # Add xmlns attribute to html node
     root.html['xmlns'] = 'http://www.w3.org/1999/xhtml'
     unicode_string = str(root.prettify(encoding='utf-8', formatter='html'), encoding='utf-8')
-    # Close singleton tag_dictionary
-    for tag in constants.SINGLETON_TAG_LIST:
-        unicode_string = unicode_string.replace(
-                '<' + tag + '/>',
-                '<' + tag + ' />')
+    # Close singleton tag_dictionary in a single pass
+    unicode_string = SINGLETON_TAG_REGEX.sub(r'<\1 />', unicode_string)
     return unicode_string
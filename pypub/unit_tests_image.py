@@ -17,6 +17,16 @@ class ChapterTests(unittest.TestCase):
                                 'http://williamcember.com/media/GitHub-Mark-Light-120px-plus.png',
                                 'http://williamcember.com/media/icon_twitter.png']
 
+    def test_get_image_type(self):
+        self.assertEqual(chapter.get_image_type('http://example.com/image.jpg'), 'jpg')
+        self.assertEqual(chapter.get_image_type('http://example.com/image.jpeg'), 'jpeg')
+        self.assertEqual(chapter.get_image_type('http://example.com/image.gif'), 'gif')
+        self.assertEqual(chapter.get_image_type('http://example.com/image.png'), 'png')
+        self.assertEqual(chapter.get_image_type('http://example.com/IMAGE.PNG'), 'png')
+        self.assertEqual(chapter.get_image_type('http://example.com/logo.png?v=2'), 'png')
+        self.assertIsNone(chapter.get_image_type('http://example.com/foojpg'))
+        self.assertIsNone(chapter.get_image_type('http://example.com/page.html'))
+
     def test_save_image(self):
         image_url_list = ['http://www.fangraphs.com/images/247_90_fangraphs.png',
                           'http://bothsides.wpengine.netdna-cdn.com/wp-content/uploads/2015/11/bothsides1.jpg']
@@ -12,6 +12,7 @@ setup(
     install_requires=[
             'beautifulsoup4',
             'jinja2',
+            'lxml',
             'requests',
             ],
     description= "Create epub's using python. Pypub is a python library to create epub files quickly without having to worry about the intricacies of the epub specification.",